@@ -1,3 +1,5 @@
+import io
+import re
 import streamlit as st
 import pandas as pd
 import numpy as np
@@ -5,6 +7,8 @@ from scipy.optimize import minimize
 import plotly.graph_objects as go
 
 # ---------- 0. UTILS ----------
+_YEAR_RE = re.compile(r"^((?:19|20)\d{2}).*\]$")      # WDI year header, e.g. "2015 [YR2015]"
+
 def _denton_mat(n_high, n_low):
     m = n_high // n_low
     rows = np.repeat(np.arange(n_low), m)
@@ -21,6 +25,58 @@ def denton_diff(low):
     res = minimize(obj, x0, method='SLSQP', constraints=cons, options={'ftol': 1e-9})
     return pd.Series(res.x, index=tgt_idx, name=low.name)
 
+@st.cache_resource(show_spinner="Parsing WDI file…")
+def load_wdi(file_bytes):
+    # keyed on the raw bytes; cache_resource hands back the same frame (no
+    # per-rerun unpickle), so callers must treat it as read-only
+    header    = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+    years     = header.str.extract(_YEAR_RE, expand=False)        # NaN for non-year columns
+    year_cols = header[years.notna()].tolist()
+    year_map  = dict(zip(year_cols, years.dropna().astype(int)))
+    id_cols   = ["Country Name", "Series Name"]              # Series Code duplicates Series Name
+    wide = pd.read_csv(io.BytesIO(file_bytes), usecols=id_cols + year_cols,   # skip Country Code & unused years
+                       engine="pyarrow", on_bad_lines="skip",        # DataBank footer rows are ragged
+                       na_values=[".."])                              # WDI's missing-value marker
+    wide[year_cols] = wide[year_cols].apply(pd.to_numeric, errors="coerce")   # column-wise, before reshape
+    return (wide
+            .set_index(id_cols)[year_cols]
+            .rename(columns=year_map)
+            .rename_axis(columns="year")
+            .stack(future_stack=True)                                 # block reshape, no per-column concat
+            .dropna()
+            .rename("value")
+            .reset_index()
+            .astype({c: "category" for c in id_cols})               # int codes for filter / pivot
+            .assign(year=lambda d: pd.to_numeric(d["year"], downcast="integer")))
+
+@st.cache_data(show_spinner=False)
+def build_panel(file_bytes, y0, y1, sel_cty, sel_ind):
+    # keyed on file + selection tuples, so unchanged filters skip the pivot
+    tidy = load_wdi(file_bytes)
+    mask = (tidy["year"].between(y0, y1)
+            & tidy["Country Name"].isin(sel_cty)
+            & tidy["Series Name"].isin(sel_ind))
+    long_sel = tidy if mask.all() else tidy.loc[mask]   # one slice, no intermediate frames
+    keys = ["Country Name", "year", "Series Name"]
+    if long_sel.duplicated(keys).any():       # pivot needs unique keys; average dupes like pivot_table did
+        long_sel = long_sel.groupby(keys, as_index=False, observed=True)["value"].mean()
+    return (long_sel
+            .pivot(index=["Country Name", "year"], columns="Series Name", values="value")
+            .reset_index())
+
+@st.cache_data(show_spinner=False)
+def panel_csv(df):
+    # serialise once per panel content, not on every rerun
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, chunksize=100_000)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def panel_parquet(df):
+    buf = io.BytesIO()
+    df.to_parquet(buf, index=False)
+    return buf.getvalue()
+
 # ---------- 1. LOAD ----------
 st.set_page_config(page_title="WDI batch processor", layout="wide")
 st.title("WDI ➜ tidy panel + batch interpolate / frequency / log")
@@ -28,35 +84,22 @@ st.title("WDI ➜ tidy panel + batch interpolate / frequency / log")
 uploaded = st.file_uploader("1. Upload WDI wide CSV", type="csv")
 if uploaded is None: st.stop()
 
-wide = pd.read_csv(uploaded)
-year_cols = [c for c in wide.columns if c.startswith("20") and c.endswith("]")]
-id_cols   = ["Country Name", "Series Name", "Series Code"]
-tidy = (wide
-        .melt(id_vars=id_cols, value_vars=year_cols,
-              var_name="year_raw", value_name="value")
-        .assign(year=lambda d: pd.to_numeric(d["year_raw"].str[:4], errors="coerce"))
-        .assign(value=lambda d: pd.to_numeric(d["value"], errors="coerce"))
-        .drop(columns=["year_raw"])
-        .dropna(subset=["year", "value"]))
-
-countries, indicators = tidy["Country Name"].unique(), tidy["Series Name"].unique()
+tidy = load_wdi(uploaded.getvalue())
+
+countries  = tidy["Country Name"].cat.categories.tolist()   # categories come out sorted
+indicators = tidy["Series Name"].unique().tolist()
 y0, y1 = int(tidy["year"].min()), int(tidy["year"].max())
 st.markdown(f"**Countries** : {len(countries)}  |  **Indicators** : {len(indicators)}  |  **Years** : {y0}–{y1}")
 
 # ---------- 2. FILTER (ALL-AT-ONCE) ----------
-with st.sidebar:
-    years = sorted(tidy["year"].unique())
+with st.sidebar, st.form("filter_form"):      # one rerun per submit, not per pick
+    years = np.unique(tidy["year"].to_numpy()).tolist()
     y0, y1 = st.select_slider("Year range", options=years, value=(y0, y1))
     sel_ind = st.multiselect("Indicators", indicators, default=indicators)
-    sel_cty = st.multiselect("Countries", sorted(countries), default=sorted(countries))
+    sel_cty = st.multiselect("Countries", countries, default=countries)
+    st.form_submit_button("Apply filters")
 
-panel = (tidy
-         .loc[tidy["year"].between(y0, y1)]
-         .loc[tidy["Country Name"].isin(sel_cty)]
-         .loc[tidy["Series Name"].isin(sel_ind)]
-         .pivot_table(index=["Country Name", "year"],
-                      columns="Series Name", values="value")
-         .reset_index())
+panel = build_panel(uploaded.getvalue(), y0, y1, tuple(sel_cty), tuple(sel_ind))
 
 # ---------- 3. GLOBAL TOGGLES ----------
 with st.sidebar:
@@ -73,8 +116,8 @@ if do_log:    note_parts.append("logged")
 note_str = " → ".join(note_parts) if note_parts else "no processing"
 
 # ---------- 4. PIPELINE (COUNTRY-WISE) ----------
-def country_pipe(g):
-    g = g.copy().set_index("year")
+def country_pipe(g, sel_ind, do_interp, do_freq, do_log, method_i):
+    g = g.set_index("year")              # already a new frame; panel comes sorted by year
     new_frames = []          # monthly frames go here
     for col in sel_ind:
         s = g[col].copy()
@@ -100,40 +143,58 @@ def country_pipe(g):
     # else: concat all monthly frames
     return pd.concat(new_frames, ignore_index=True)
 
-if any([do_interp, do_freq, do_log]):
-    st.info(f"Pipeline: {note_str}  (country-specific)")
+@st.cache_data(show_spinner="Running pipeline…")
+def process_panel(file_bytes, y0, y1, sel_cty, sel_ind, do_interp, do_freq, do_log, method_i):
+    # same key as build_panel + toggles, so Denton only reruns when its inputs change
+    panel = build_panel(file_bytes, y0, y1, sel_cty, sel_ind)
     processed, skipped = [], []
+    groups = dict(list(panel.groupby("Country Name", sort=False, observed=True)))   # one pass, not one scan per country
     for cty in sel_cty:
-        sub = panel.query("`Country Name` == @cty")
-        if sub.empty: continue
+        sub = groups.get(cty)
+        if sub is None: continue
         try:
-            processed.append(country_pipe(sub))
+            processed.append(country_pipe(sub, sel_ind, do_interp, do_freq, do_log, method_i))
         except ValueError:
             skipped.append(cty)
+    panel_proc = pd.concat(processed, ignore_index=True) if processed else panel
+    return panel_proc, skipped
+
+if any([do_interp, do_freq, do_log]):
+    st.info(f"Pipeline: {note_str}  (country-specific)")
+    panel_proc, skipped = process_panel(uploaded.getvalue(), y0, y1, tuple(sel_cty), tuple(sel_ind),
+                                        do_interp, do_freq, do_log, method_i)
     if skipped:
         st.warning("Skipped countries (need ≥2 yrs for freq): " + ", ".join(skipped))
-    panel_proc = pd.concat(processed, ignore_index=True) if processed else panel
 else:
     panel_proc = panel
 
-# ---------- 5. BEFORE / AFTER WORLD CHART ----------
-if any([do_interp, do_freq, do_log]) and not panel_proc.empty:
-    st.subheader("World aggregate: before vs after")
-    # choose correct index name
-    idx_col = "date" if do_freq else "year"
-    bef_world = (panel.groupby("year")[sel_ind].mean())
-    aft_world = (panel_proc.groupby(idx_col)[sel_ind].mean())
-    fig = go.Figure()
-    for ind in sel_ind[:3]:
-        fig.add_scatter(x=bef_world.index, y=bef_world[ind], name=f"{ind} (before)", mode="markers")
-        fig.add_scatter(x=aft_world.index, y=aft_world[ind], name=f"{ind} (after)",  mode="lines")
-    st.plotly_chart(fig, use_container_width=True)
-
-# ---------- 6. DOWNLOAD ----------
-csv_final = panel_proc.to_csv(index=False)
-st.download_button(
-        label=f"Download processed panel ({note_str})",
-        data=csv_final,
-        file_name=f"wdi_processed_{y0}_{y1}.csv",
-        mime="text/csv"
-)
+# ---------- 5. BEFORE / AFTER WORLD CHART + 6. DOWNLOAD ----------
+@st.fragment
+def render_chart_and_download(panel, panel_proc):
+    # fragment: clicking download reruns only this block, not the pipeline
+    if any([do_interp, do_freq, do_log]) and not panel_proc.empty:
+        st.subheader("World aggregate: before vs after")
+        # choose correct index name
+        idx_col = "date" if do_freq else "year"
+        bef_world = (panel.groupby("year")[sel_ind].mean())
+        aft_world = (panel_proc.groupby(idx_col)[sel_ind].mean())
+        fig = go.Figure()
+        for ind in sel_ind[:3]:
+            fig.add_scatter(x=bef_world.index, y=bef_world[ind], name=f"{ind} (before)", mode="markers")
+            fig.add_scatter(x=aft_world.index, y=aft_world[ind], name=f"{ind} (after)",  mode="lines")
+        st.plotly_chart(fig, use_container_width=True)
+
+    st.download_button(
+            label=f"Download processed panel ({note_str})",
+            data=panel_csv(panel_proc),
+            file_name=f"wdi_processed_{y0}_{y1}.csv",
+            mime="text/csv"
+    )
+    st.download_button(
+            label=f"Download processed panel as Parquet ({note_str})",
+            data=panel_parquet(panel_proc),
+            file_name=f"wdi_processed_{y0}_{y1}.parquet",
+            mime="application/vnd.apache.parquet"
+    )
+
+render_chart_and_download(panel, panel_proc)